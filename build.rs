@@ -47,73 +47,26 @@ fn main() {
     cc::Build::new().file("src/ioctl.c").compile("ioctl");
     println!("cargo:rerun-if-changed=src/ioctl.c");
 
-    Command::new("scripts/generate_syscalls.py")
+    let status = Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_consts_x64_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_consts_x86_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_const_asserts_x86_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_const_asserts_x64_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_record_case_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("assembly_templates_generated.rs"))
-        .status()
-        .unwrap();
-
-    // These are typically not needed. Uncomment and use when necessary e.g. there are new syscalls
-    /*
-    Command::new("scripts/generate_syscalls.py")
-        .arg(path.join("syscall_consts_trait_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
-        .arg(path.join("syscall_consts_trait_impl_x86_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
-        .arg(path.join("syscall_consts_trait_impl_x64_generated.rs"))
-        .status()
-        .unwrap();
-    */
-
-    Command::new("scripts/generate_syscalls.py")
+        // These are typically not needed. Uncomment and use when necessary e.g. there are new syscalls
+        // .arg(path.join("syscall_consts_trait_generated.rs"))
+        // .arg(path.join("syscall_consts_trait_impl_x86_generated.rs"))
+        // .arg(path.join("syscall_consts_trait_impl_x64_generated.rs"))
         .arg(path.join("syscall_name_arch_x64_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_name_arch_x86_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("syscall_helper_functions_generated.rs"))
-        .status()
-        .unwrap();
-
-    Command::new("scripts/generate_syscalls.py")
         .arg(path.join("check_syscall_numbers_generated.rs"))
         .status()
         .unwrap();
+    if !status.success() {
+        panic!("scripts/generate_syscalls.py failed: {}", status);
+    }
 
     println!("cargo:rerun-if-changed=scripts/generate_syscalls.py");
     println!("cargo:rerun-if-changed=scripts/assembly_templates.py");
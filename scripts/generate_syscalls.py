@@ -1,26 +1,41 @@
 #!/usr/bin/env python3
 
-import assembly_templates
-from enum import Enum
-from io import StringIO
+import functools
+import hashlib
 import os
-import string
+import shutil
+import stat
 import sys
-import syscalls
+import tempfile
 
-def arch_syscall_number(arch, syscall):
-    s = getattr(syscall[1], arch)
-    if s == None:
-        s = -1
-    return s
+@functools.lru_cache(maxsize=None)
+def _all_syscalls():
+    import syscalls
+    return tuple((name, name.upper(), obj) for name, obj in syscalls.all())
 
-def write_syscall_consts(f, arch, mode):
-    f.write("// This file has been autogenerated. DO NOT MODIFY!\n")
+@functools.lru_cache(maxsize=None)
+def _sorted_syscalls(arch):
+    """(name, upper, obj, syscall_number) for every syscall, sorted by its number on `arch`."""
+    # Decorate with an integer sort key and the original position, so the
+    # sort compares plain ints and stays stable without a key function.
+    keyed = []
+    for index, (name, upper, obj) in enumerate(_all_syscalls()):
+        syscall_number = getattr(obj, arch)
+        keyed.append((-1 if syscall_number is None else syscall_number, index,
+                      (name, upper, obj, syscall_number)))
+    keyed.sort()
+    return tuple(row for _, _, row in keyed)
+
+@functools.lru_cache(maxsize=None)
+def _compute_syscall_rows(arch):
+    """(upper, enum_number) for every syscall on `arch`, plus the valid and
+    invalid syscall counts. Syscalls missing on `arch` get unique negative
+    numbers."""
+    rows = []
     undefined_syscall = -1
     valid_syscalls = 0
     invalid_syscalls = 0
-    for name, obj in sorted(syscalls.all(), key=lambda x: arch_syscall_number(arch, x)):
-        syscall_number = getattr(obj, arch)
+    for name, upper, obj, syscall_number in _sorted_syscalls(arch):
         if syscall_number is not None:
             enum_number = syscall_number
             valid_syscalls += 1
@@ -28,163 +43,182 @@ def write_syscall_consts(f, arch, mode):
             enum_number = undefined_syscall
             undefined_syscall -= 1
             invalid_syscalls += 1
-        if mode == SyscallGen.CONST_ASSERTS:
-            if arch == 'x86':
-                f.write("const_assert_eq!(X86Arch::%s, %d);\n" % (name.upper(), enum_number))
-            elif arch == 'x64':
-                f.write("const_assert_eq!(X64Arch::%s, %d);\n" % (name.upper(), enum_number))
-        elif mode == SyscallGen.DEFAULT:
-            f.write("pub const %s: i32 = %d;\n" % (name.upper(), enum_number))
-        elif mode == SyscallGen.TRAIT:
-            f.write("const %s: i32;\n" % (name.upper()))
-        elif mode == SyscallGen.TRAIT_IMPL:
-            f.write("const %s: i32 = %d;\n" % (name.upper(), enum_number))
-    if mode == SyscallGen.CONST_ASSERTS:
-        if arch == 'x86':
-            f.write("const_assert_eq!(X86Arch::VALID_SYSCALL_COUNT, %d);\n" % (valid_syscalls))
-            f.write("const_assert_eq!(X86Arch::INVALID_SYSCALL_COUNT, %d);\n" % (invalid_syscalls))
-        elif arch == 'x64':
-            f.write("const_assert_eq!(X64Arch::VALID_SYSCALL_COUNT, %d);\n" % (valid_syscalls))
-            f.write("const_assert_eq!(X64Arch::INVALID_SYSCALL_COUNT, %d);\n" % (invalid_syscalls))
-    elif mode == SyscallGen.DEFAULT:
-        f.write("pub const VALID_SYSCALL_COUNT: i32 = %d;\n" % (valid_syscalls))
-        f.write("pub const INVALID_SYSCALL_COUNT: i32 = %d;\n" % (invalid_syscalls))
-    elif mode == SyscallGen.TRAIT:
-        f.write("const VALID_SYSCALL_COUNT: i32;\n")
-        f.write("const INVALID_SYSCALL_COUNT: i32;\n")
-    elif mode == SyscallGen.TRAIT_IMPL:
-        f.write("const VALID_SYSCALL_COUNT: i32 = %d;\n" % (valid_syscalls))
-        f.write("const INVALID_SYSCALL_COUNT: i32 = %d;\n" % (invalid_syscalls))
+        rows.append((upper, enum_number))
+    return tuple(rows), valid_syscalls, invalid_syscalls
+
+def format_syscall_consts(_arch, rows, valid_syscalls, invalid_syscalls):
+    parts = []
+    for upper, enum_number in rows:
+        parts.append(f"pub const {upper}: i32 = {enum_number};\n")
+    parts.append(f"pub const VALID_SYSCALL_COUNT: i32 = {valid_syscalls};\n")
+    parts.append(f"pub const INVALID_SYSCALL_COUNT: i32 = {invalid_syscalls};\n")
+    return "".join(parts)
+
+def format_syscall_const_asserts(arch, rows, valid_syscalls, invalid_syscalls):
+    parts = []
+    arch_type = {'x86': 'X86Arch', 'x64': 'X64Arch'}[arch]
+    for upper, enum_number in rows:
+        parts.append(f"const_assert_eq!({arch_type}::{upper}, {enum_number});\n")
+    parts.append(f"const_assert_eq!({arch_type}::VALID_SYSCALL_COUNT, {valid_syscalls});\n")
+    parts.append(f"const_assert_eq!({arch_type}::INVALID_SYSCALL_COUNT, {invalid_syscalls});\n")
+    return "".join(parts)
+
+def format_syscall_consts_trait(_arch, rows, _valid_syscalls, _invalid_syscalls):
+    parts = []
+    for upper, _enum_number in rows:
+        parts.append(f"const {upper}: i32;\n")
+    parts.append("const VALID_SYSCALL_COUNT: i32;\n")
+    parts.append("const INVALID_SYSCALL_COUNT: i32;\n")
+    return "".join(parts)
+
+def format_syscall_consts_trait_impl(_arch, rows, valid_syscalls, invalid_syscalls):
+    parts = []
+    for upper, enum_number in rows:
+        parts.append(f"const {upper}: i32 = {enum_number};\n")
+    parts.append(f"const VALID_SYSCALL_COUNT: i32 = {valid_syscalls};\n")
+    parts.append(f"const INVALID_SYSCALL_COUNT: i32 = {invalid_syscalls};\n")
+    return "".join(parts)
+
+def write_syscall_consts(f, arch, mode):
+    rows, valid_syscalls, invalid_syscalls = _compute_syscall_rows(arch)
+    f.write("// This file has been autogenerated. DO NOT MODIFY!\n")
+    f.write(syscall_consts_formatters[mode](arch, rows, valid_syscalls, invalid_syscalls))
 
 def write_syscall_consts_for_tests(f, arch):
+    rows, _, _ = _compute_syscall_rows(arch)
     f.write("// This file has been autogenerated. DO NOT MODIFY!\n")
-    undefined_syscall = -1
-    for name, obj in sorted(syscalls.all(), key=lambda x: arch_syscall_number(arch, x)):
-        syscall_number = getattr(obj, arch)
-        if syscall_number is not None:
-            enum_number = syscall_number
-        else:
-            enum_number = undefined_syscall
-            undefined_syscall -= 1
-        f.write("pub const RR_%s = %d,\n" % (name.upper(), enum_number))
+    for upper, enum_number in rows:
+        f.write(f"pub const RR_{upper} = {enum_number},\n")
     f.write("\n")
 
+@functools.lru_cache(maxsize=None)
+def _syscallname_arms(arch):
+    """The match arms of syscallname_arch() for every syscall on `arch`."""
+    import syscalls
+    uppers = {name: upper for name, upper, obj in _all_syscalls()}
+    return "".join(f"        {uppers[name]} => \"{name}\".into(),\n"
+                   for name, obj in syscalls.for_arch(arch))
+
 def write_syscallname_arch(f, arch):
-    f.write("// This file has been autogenerated. DO NOT MODIFY!\n")
-    f.write("pub fn syscallname_arch(syscall: i32) -> String {\n")
-    f.write("    match syscall {\n");
-    def write_case(name):
-        f.write("        %(syscall_upper)s => \"%(syscall)s\".into(),\n"
-                % { 'syscall_upper': name.upper(), 'syscall': name })
-    for name, _ in syscalls.for_arch(arch):
-        write_case(name)
-    f.write("        _ => format!(\"<unknown-syscall-{}>\", syscall),\n")
-    f.write("    }\n")
-    f.write("}\n")
-    f.write("\n")
+    f.write("// This file has been autogenerated. DO NOT MODIFY!\n"
+            "pub fn syscallname_arch(syscall: i32) -> String {\n"
+            "    match syscall {\n"
+            + _syscallname_arms(arch) +
+            "        _ => format!(\"<unknown-syscall-{}>\", syscall),\n"
+            "    }\n"
+            "}\n"
+            "\n")
 
-def write_syscall_record_cases(f):
-    def write_recorder_for_arg(syscall, arg):
-        arg_descriptor = getattr(syscall, 'arg' + str(arg), None)
-        if isinstance(arg_descriptor, str):
-            f.write("        syscall_state.reg_parameter::<%s>(%d, None, None);\n"
-                    % (arg_descriptor, arg))
-    f.write("// This file has been autogenerated. DO NOT MODIFY!\n")
-    f.write("{\n")
-    f.write("    use crate::kernel_abi::common;\n")
-    f.write("    use crate::kernel_abi::x64;\n")
-    for name, obj in syscalls.all():
-        # Irregular syscalls will be handled by hand-written code elsewhere.
+@functools.lru_cache(maxsize=None)
+def _regular_syscalls():
+    """(upper, args) for every RegularSyscall, where `args` holds the
+    (arg number, type) of each argument to record."""
+    import syscalls
+    regular = []
+    for name, upper, obj in _all_syscalls():
         if isinstance(obj, syscalls.RegularSyscall):
-            f.write("    if sys == Arch::%s {\n" % name.upper())
-            for arg in range(1,6):
-                write_recorder_for_arg(obj, arg)
-            f.write("        return Switchable::PreventSwitch;\n")
-            f.write("    }\n")
-    f.write("}\n")
-
-has_syscall = string.Template("""${no_snake_case}
-pub fn has_${syscall}_syscall(arch: SupportedArch) -> bool {
-    match arch {
-        X86 => x86::${syscall_upper} >= 0,
-        X64 => x64::${syscall_upper} >= 0,
-    }
-}
-""")
-
-is_syscall = string.Template("""${no_snake_case}
-pub fn is_${syscall}_syscall(syscallno: i32, arch: SupportedArch) -> bool {
-    match arch {
-        X86 => syscallno >= 0 && syscallno == x86::${syscall_upper},
-        X64 => syscallno >= 0 && syscallno == x64::${syscall_upper},
-    }
-}
-""")
-
-syscall_number = string.Template("""${no_snake_case}
-pub fn syscall_number_for_${syscall}(arch: SupportedArch) -> i32 {
-    match arch {
-        X86 => {
-            debug_assert!(x86::${syscall_upper} >= 0);
-            x86::${syscall_upper}
-        }
-        X64 => {
-            debug_assert!(x64::${syscall_upper} >= 0);
-            x64::${syscall_upper}
-        },
-    }
-}
-""")
+            args = ((arg, getattr(obj, f'arg{arg}', None)) for arg in range(1,6))
+            regular.append((upper, tuple((arg, t) for arg, t in args if isinstance(t, str))))
+    return tuple(regular)
+
+def write_syscall_record_cases(f):
+    parts = []
+    parts.append("// This file has been autogenerated. DO NOT MODIFY!\n")
+    parts.append("{\n")
+    parts.append("    use crate::kernel_abi::common;\n")
+    parts.append("    use crate::kernel_abi::x64;\n")
+    # Irregular syscalls will be handled by hand-written code elsewhere.
+    for upper, args in _regular_syscalls():
+        parts.append(f"    if sys == Arch::{upper} {{\n")
+        for arg, arg_descriptor in args:
+            parts.append(f"        syscall_state.reg_parameter::<{arg_descriptor}>({arg}, None, None);\n")
+        parts.append("        return Switchable::PreventSwitch;\n")
+        parts.append("    }\n")
+    parts.append("}\n")
+    f.write("".join(parts))
+
+syscall_helpers_template = """{no_snake_case}
+pub fn has_{syscall}_syscall(arch: SupportedArch) -> bool {{
+    match arch {{
+        X86 => x86::{syscall_upper} >= 0,
+        X64 => x64::{syscall_upper} >= 0,
+    }}
+}}
+{no_snake_case}
+pub fn is_{syscall}_syscall(syscallno: i32, arch: SupportedArch) -> bool {{
+    match arch {{
+        X86 => syscallno >= 0 && syscallno == x86::{syscall_upper},
+        X64 => syscallno >= 0 && syscallno == x64::{syscall_upper},
+    }}
+}}
+{no_snake_case}
+pub fn syscall_number_for_{syscall}(arch: SupportedArch) -> i32 {{
+    match arch {{
+        X86 => {{
+            debug_assert!(x86::{syscall_upper} >= 0);
+            x86::{syscall_upper}
+        }}
+        X64 => {{
+            debug_assert!(x64::{syscall_upper} >= 0);
+            x64::{syscall_upper}
+        }},
+    }}
+}}
+"""
 
 def write_syscall_helper_functions(f):
-    def write_helpers(syscall):
-        no_snake_case = ''
+    def no_snake_case(syscall):
         if syscall.startswith('_') or syscall.endswith('_'):
-            no_snake_case = '\n#[allow(non_snake_case)]'
-        subs = {'syscall': syscall, 'syscall_upper': syscall.upper(),
-                'no_snake_case': no_snake_case}
-        f.write(has_syscall.safe_substitute(subs))
-        f.write(is_syscall.safe_substitute(subs))
-        f.write(syscall_number.safe_substitute(subs))
+            return '\n#[allow(non_snake_case)]'
+        return ''
 
     f.write("// This file has been autogenerated. DO NOT MODIFY!\n")
     f.write("use SupportedArch::*;\n")
-    for name, obj in syscalls.all():
-        write_helpers(name)
+    render = syscall_helpers_template.format
+    f.write("".join(render(syscall=name, syscall_upper=upper, no_snake_case=no_snake_case(name))
+                    for name, upper, obj in _all_syscalls()))
+
+@functools.lru_cache(maxsize=None)
+def _x64_syscall_number_sources():
+    """(upper, name, module) for every x64 syscall, where `module` is the Rust
+    module defining its SYS_ constant."""
+    # @TODO hard-coded to x64 currently
+    # @TODO Note this is different from rr where it is hardcoded to x86
+    return tuple((upper, name, "preload_interface" if name.startswith("rdcall_") else "libc")
+                 for name, upper, obj in _all_syscalls() if obj.x64)
 
 def write_check_syscall_numbers(f):
     f.write("""use crate::arch::{Architecture, X86Arch, X64Arch};\n""")
     f.write("""use crate::kernel_abi::common::preload_interface;\n""")
-    for name, obj in syscalls.all():
-        # @TODO hard-coded to x64 currently
-        # @TODO Note this is different from rr where it is hardcoded to x86
-        if not obj.x64:
-            continue
-        if name.startswith("rdcall_"):
-            f.write("""const_assert_eq!(X64Arch::%s, preload_interface::SYS_%s as i32);\n"""
-                    % (name.upper(), name))
-        else:
-            f.write("""const_assert_eq!(X64Arch::%s, libc::SYS_%s as i32);\n"""
-                % (name.upper(), name))
+    f.write("".join(f"const_assert_eq!(X64Arch::{upper}, {module}::SYS_{name} as i32);\n"
+                    for upper, name, module in _x64_syscall_number_sources()))
 
 
-class SyscallGen(Enum):
-    DEFAULT = 1
-    CONST_ASSERTS = 2
-    TRAIT = 3
-    TRAIT_IMPL = 4
+def write_assembly_templates(f):
+    import assembly_templates
+    assembly_templates.generate(f)
+
+# Modes for write_syscall_consts.
+DEFAULT, CONST_ASSERTS, TRAIT, TRAIT_IMPL = 1, 2, 3, 4
+
+syscall_consts_formatters = {
+    DEFAULT: format_syscall_consts,
+    CONST_ASSERTS: format_syscall_const_asserts,
+    TRAIT: format_syscall_consts_trait,
+    TRAIT_IMPL: format_syscall_consts_trait_impl,
+}
 
 generators_for = {
-    'assembly_templates_generated': lambda f: assembly_templates.generate(f),
+    'assembly_templates_generated': write_assembly_templates,
     'check_syscall_numbers_generated': write_check_syscall_numbers,
-    'syscall_consts_x86_generated': lambda f: write_syscall_consts(f, 'x86', SyscallGen.DEFAULT),
-    'syscall_consts_x64_generated': lambda f: write_syscall_consts(f, 'x64', SyscallGen.DEFAULT),
-    'syscall_const_asserts_x86_generated': lambda f: write_syscall_consts(f, 'x86', SyscallGen.CONST_ASSERTS),
-    'syscall_const_asserts_x64_generated': lambda f: write_syscall_consts(f, 'x64', SyscallGen.CONST_ASSERTS),
+    'syscall_consts_x86_generated': lambda f: write_syscall_consts(f, 'x86', DEFAULT),
+    'syscall_consts_x64_generated': lambda f: write_syscall_consts(f, 'x64', DEFAULT),
+    'syscall_const_asserts_x86_generated': lambda f: write_syscall_consts(f, 'x86', CONST_ASSERTS),
+    'syscall_const_asserts_x64_generated': lambda f: write_syscall_consts(f, 'x64', CONST_ASSERTS),
     # The architecture x86 is arbitrary here. Could have been x64 also.
-    'syscall_consts_trait_generated': lambda f: write_syscall_consts(f, 'x86', SyscallGen.TRAIT),
-    'syscall_consts_trait_impl_x86_generated': lambda f: write_syscall_consts(f, 'x86', SyscallGen.TRAIT_IMPL),
-    'syscall_consts_trait_impl_x64_generated': lambda f: write_syscall_consts(f, 'x64', SyscallGen.TRAIT_IMPL),
+    'syscall_consts_trait_generated': lambda f: write_syscall_consts(f, 'x86', TRAIT),
+    'syscall_consts_trait_impl_x86_generated': lambda f: write_syscall_consts(f, 'x86', TRAIT_IMPL),
+    'syscall_consts_trait_impl_x64_generated': lambda f: write_syscall_consts(f, 'x64', TRAIT_IMPL),
     'syscall_consts_for_tests_x86_generated': lambda f: write_syscall_consts_for_tests(f, 'x86'),
     'syscall_consts_for_tests_x64_generated': lambda f: write_syscall_consts_for_tests(f, 'x64'),
     'syscall_name_arch_x86_generated': lambda f: write_syscallname_arch(f, 'x86'),
@@ -193,24 +227,142 @@ generators_for = {
     'syscall_helper_functions_generated': write_syscall_helper_functions,
 }
 
-def main(argv):
-    filename = argv[0]
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The generated output depends only on these files.
+generator_inputs = [
+    os.path.join(scripts_dir, 'syscalls.py'),
+    os.path.join(scripts_dir, 'assembly_templates.py'),
+    os.path.abspath(__file__),
+]
+
+def cache_file_for(filename, base):
+    """Where the output of generator `base` is cached for the current inputs."""
+    key = hashlib.blake2b(digest_size=16)
+    for path in generator_inputs:
+        key.update(b'\0%d' % os.stat(path).st_mtime_ns)
+    cache_dir = os.path.join(os.path.dirname(filename), '.build_cache', 'syscalls')
+    return os.path.join(cache_dir, f'{base}-{key.hexdigest()}.txt')
+
+def store_in_cache(src, cache_file, base):
+    """Atomically stores `src` as `cache_file`, dropping the entries of
+    generator `base` that were cached for older inputs."""
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    copy_atomically(src, cache_file)
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        if entry.startswith(base + '-') and entry.endswith('.txt') and path != cache_file:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def is_up_to_date(filename, inputs_mtime):
+    """Whether `filename` was generated from the current inputs, i.e. it or the
+    stamp file written alongside it is newer than every input."""
+    if not os.access(filename, os.F_OK):
+        return False
+    if os.path.getmtime(filename) >= inputs_mtime:
+        return True
+    stamp = filename + '.stamp'
+    return os.access(stamp, os.F_OK) and os.path.getmtime(stamp) >= inputs_mtime
+
+class HashingWriter(object):
+    """Writes generated text to a binary file, hashing it on the way."""
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.blake2b()
+
+    def write(self, s):
+        data = s.encode()
+        self.f.write(data)
+        self.hash.update(data)
+
+    def digest(self):
+        return self.hash.digest()
+
+def file_digest(filename):
+    """blake2b digest of the contents of `filename`, or None if it does not exist."""
+    if not os.access(filename, os.F_OK):
+        return None
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def temp_file_for(filename):
+    """A new, uniquely named temp file in the same directory as `filename`, so
+    it can be renamed over `filename` atomically."""
+    return tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or '.',
+                                       prefix=os.path.basename(filename) + '.',
+                                       suffix='.tmp', delete=False)
+
+def replace_with_temp_file(tmp_name, dst):
+    """Renames `tmp_name` over `dst`, giving it the mode `dst` already has, or
+    the mode a plainly created file would get. mkstemp creates temp files
+    with mode 0600."""
+    try:
+        mode = stat.S_IMODE(os.stat(dst).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(tmp_name, mode)
+    os.replace(tmp_name, dst)
+
+def copy_atomically(src, dst):
+    """Copies `src` to `dst` through a temp file, so `dst` is never left
+    partially written."""
+    tmp = temp_file_for(dst)
+    try:
+        with tmp, open(src, 'rb') as f:
+            shutil.copyfileobj(f, tmp)
+        replace_with_temp_file(tmp.name, dst)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+
+def generate_file(filename):
     base, extension = os.path.splitext(os.path.basename(filename))
 
-    if os.access(filename, os.F_OK):
-        with open(filename, 'r') as f:
-            before = f.read()
+    cache_file = cache_file_for(filename, base)
+    if os.access(cache_file, os.F_OK):
+        if file_digest(cache_file) != file_digest(filename):
+            copy_atomically(cache_file, filename)
     else:
-        before = ""
-
-    stream = StringIO()
-    generators_for[base](stream)
-    after = stream.getvalue()
-    stream.close()
+        tmp = temp_file_for(filename)
+        try:
+            with tmp:
+                stream = HashingWriter(tmp)
+                generators_for[base](stream)
+            if stream.digest() != file_digest(filename):
+                replace_with_temp_file(tmp.name, filename)
+            else:
+                os.remove(tmp.name)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+        # The cache is only an optimization, so failing to fill it must not
+        # fail the build.
+        try:
+            store_in_cache(filename, cache_file, base)
+        except OSError:
+            pass
+    # The output is only rewritten when it changes, so record when it was
+    # last checked against the current inputs.
+    with open(filename + '.stamp', 'w'):
+        pass
 
-    if before != after:
-        with open(filename, 'w') as f:
-            f.write(after)
+def main(argv):
+    # All outputs are generated in one process so the syscall tables are
+    # imported and computed only once. syscalls and assembly_templates are
+    # imported lazily, so nothing is imported when every output is fresh.
+    inputs_mtime = max(os.path.getmtime(path) for path in generator_inputs)
+    stale = [filename for filename in argv if not is_up_to_date(filename, inputs_mtime)]
+    for filename in stale:
+        generate_file(filename)
 
 if __name__ == '__main__':
     main(sys.argv[1:])